@@ -15,3 +15,50 @@ class Configuration:
         "inception_v3",
     )
     img_allowed = ('image/jpeg', 'image/png', 'image/gif', 'image/webp')
+    models_folder_path = os.path.join(project_root, "models")  # precompiled artifacts
+
+    # admission control of the classification endpoints
+    latency_slo_seconds = 2.0
+    max_queue_depth = 16
+    classification_concurrency = 2  # classifications running at once
+    fallback_models = ("alexnet", "resnet18")  # cheapest first
+    latency_ewma_alpha = 0.2
+    latency_probe_seconds = 30.0  # a model without samples for this long gets a probe request
+    # expected latency of every model on CPU before any request is measured
+    model_latency_priors = {
+        "resnet18": 0.1,
+        "alexnet": 0.1,
+        "vgg16": 0.8,
+        "inception_v3": 0.4,
+    }
+
+    # dataset preparation, the URLs may also be local paths or mirrors
+    images_archive_url = (
+        "https://github.com/EliSchwartz/"
+        "imagenet-sample-images/archive/master.zip"
+    )
+    labels_url = (
+        "https://raw.githubusercontent.com/"
+        "anishathalye/imagenet-simple-labels/"
+        "master/imagenet-simple-labels.json"
+    )
+    download_cache_path = os.path.join(project_root, "downloads")
+    manifest_name = "gallery_manifest.json"
+
+    # similar-image search
+    index_folder_path = os.path.join(project_root, "index")
+    index_batch_size = 32
+    index_nlist = 0  # number of IVF lists, 0 for exact search
+    index_nprobe = 8
+    similar_top_k = 8
+
+    # classification results kept for downloads
+    result_ttl_seconds = 3600
+    result_store_size = 1024
+    result_store_db = None  # path of an optional SQLite file backing the store
+
+
+def artifact_path(model_id):
+    """Returns the path of the precompiled artifact of the model
+    written by prepare_models.py."""
+    return os.path.join(Configuration.models_folder_path, f"{model_id}.pt2")
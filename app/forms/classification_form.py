@@ -7,11 +7,13 @@ class ClassificationForm:
         self.errors: list = []
         self.image_id: str = ""
         self.model_id: str = ""
+        self.allow_fallback: bool = False
 
     async def load_data(self):
         form = await self.request.form()
         self.image_id = form.get("image_id")
         self.model_id = form.get("model_id")
+        self.allow_fallback = form.get("allow_fallback") is not None
 
     def is_valid(self):
         if not self.image_id or not isinstance(self.image_id, str):
@@ -13,6 +13,7 @@ class ClassificationUploadForm:
         self.request = request
         self.errors: List[str] = []
         self.model_id: str = ""
+        self.allow_fallback: bool = False
         self.image: datastructures.UploadFile
         self.image_bytes: bytes
 
@@ -20,6 +21,7 @@ class ClassificationUploadForm:
         form_data = await self.request.form()
         self.model_id = form_data.get("selected_model")
         self.image = form_data.get("uploaded_image")
+        self.allow_fallback = form_data.get("allow_fallback") is not None
 
         if self.image:
             try:
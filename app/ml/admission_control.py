@@ -0,0 +1,169 @@
+"""
+Admission control for the classification endpoints. The controller keeps
+track of the requests in flight and of the recent latency of every model,
+estimates how long a new request would take and, when the latency SLO is
+at risk, either sheds the request or serves it with a cheaper model if
+the client allows it.
+"""
+import math
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from app.config import Configuration
+
+conf = Configuration()
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed, retry_after is in seconds."""
+
+    def __init__(self, model_id, retry_after):
+        super().__init__(f"Service overloaded, retry {model_id} in {retry_after}s")
+        self.model_id = model_id
+        self.retry_after = retry_after
+
+
+def timed(func, *args, **kwargs):
+    """Calls func and returns its result along with the seconds it took."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+class AdmissionController:
+    """Decides which requests are admitted and by which model they are
+    served, and exposes the policy decisions as metrics.
+
+    The latency of a model is only measured on the requests it serves, so
+    a model whose estimate went above the SLO would never be measured
+    again. To let the estimate recover, a request is always admitted when
+    nothing is in flight, and a model left without samples for
+    probe_interval seconds gets one probe request through."""
+
+    def __init__(self, slo=conf.latency_slo_seconds, max_queue_depth=conf.max_queue_depth,
+                 concurrency=conf.classification_concurrency,
+                 fallback_models=conf.fallback_models, alpha=conf.latency_ewma_alpha,
+                 priors=conf.model_latency_priors, probe_interval=conf.latency_probe_seconds,
+                 clock=time.monotonic):
+        self.slo = slo
+        self.max_queue_depth = max_queue_depth
+        self.concurrency = concurrency
+        self.fallback_models = fallback_models
+        self.alpha = alpha
+        self.probe_interval = probe_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        # exponentially weighted moving average of the latency of every
+        # model, seeded with the priors until requests are measured
+        self._latency = dict(priors)
+        self._last_sample = {}
+        # the priors count as samples taken at startup, so that they are
+        # trusted for probe_interval seconds like a measured latency
+        self._started = clock()
+        self._probing = set()
+        self._in_flight = 0
+        # sum of the expected latency of the requests in flight
+        self._pending = 0.0
+        self._decisions = Counter()
+
+    def _expected(self, model_id):
+        # models without a prior are assumed to use the whole SLO
+        return self._latency.get(model_id, self.slo)
+
+    def _predict(self, model_id):
+        """Expected latency of a new request for model_id, including the
+        wait for the requests already in flight."""
+        return self._pending / self.concurrency + self._expected(model_id)
+
+    def _needs_probe(self, model_id):
+        last_sample = self._last_sample.get(model_id, self._started)
+        return (
+            model_id not in self._probing
+            and self.clock() - last_sample >= self.probe_interval
+        )
+
+    def _choose(self, model_id, allow_fallback):
+        """Returns the model that serves the request and whether it is a
+        probe, or raises Overloaded. Must be called with the lock held."""
+        if self._in_flight == 0:
+            self._decisions["admitted", model_id] += 1
+            return model_id, False
+        if self._in_flight < self.max_queue_depth:
+            if self._predict(model_id) <= self.slo:
+                self._decisions["admitted", model_id] += 1
+                return model_id, False
+            if self._needs_probe(model_id):
+                self._decisions["probed", model_id] += 1
+                return model_id, True
+            if allow_fallback:
+                for fallback_id in self.fallback_models:
+                    if fallback_id != model_id and self._predict(fallback_id) <= self.slo:
+                        self._decisions["degraded", f"{model_id}->{fallback_id}"] += 1
+                        return fallback_id, False
+        self._decisions["rejected", model_id] += 1
+        # the queue drains at the rate of the workers
+        retry_after = max(1, math.ceil(self._pending / self.concurrency))
+        raise Overloaded(model_id, retry_after)
+
+    def seed(self, latencies):
+        """Replaces the estimates with measured latencies, e.g. those of
+        the warm-up runs at startup."""
+        with self._lock:
+            for model_id, elapsed in latencies.items():
+                self._latency[model_id] = elapsed
+                self._last_sample[model_id] = self.clock()
+
+    def observe(self, model_id, elapsed):
+        """Adds a latency sample of model_id to its moving average."""
+        with self._lock:
+            self._observe(model_id, elapsed)
+
+    def _observe(self, model_id, elapsed):
+        previous = self._latency.get(model_id)
+        self._latency[model_id] = elapsed if previous is None else (
+            self.alpha * elapsed + (1 - self.alpha) * previous
+        )
+        self._last_sample[model_id] = self.clock()
+
+    @contextmanager
+    def admit(self, model_id, allow_fallback=False):
+        """Admits a request for model_id and yields the id of the model
+        that has to serve it, counting the request as in flight until it
+        ends. The latency is not measured here, as the request may wait
+        for a worker first: the caller times the work of the model with
+        timed and reports it with observe, only if the request succeeds."""
+        with self._lock:
+            served_id, probe = self._choose(model_id, allow_fallback)
+            expected = self._expected(served_id)
+            self._in_flight += 1
+            self._pending += expected
+            if probe:
+                self._probing.add(served_id)
+        try:
+            yield served_id
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._pending = max(0.0, self._pending - expected)
+                if probe:
+                    self._probing.discard(served_id)
+
+    def metrics(self):
+        """Returns the current state of the controller and the count of
+        the policy decisions taken so far."""
+        with self._lock:
+            decisions = {}
+            for (decision, key), count in self._decisions.items():
+                decisions.setdefault(decision, {})[key] = count
+            return {
+                "in_flight": self._in_flight,
+                "pending_seconds": self._pending,
+                "latency_slo_seconds": self.slo,
+                "latency_seconds": dict(self._latency),
+                "decisions": decisions,
+            }
+
+
+admission_controller = AdmissionController()
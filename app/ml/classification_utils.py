@@ -7,11 +7,13 @@ import json
 import logging
 import os
 import io
+import threading
+import time
 import torch
 from PIL import Image
 from torchvision import transforms
 
-from app.config import Configuration
+from app.config import Configuration, artifact_path
 
 
 conf = Configuration()
@@ -49,17 +51,74 @@ def get_model(model_id):
             return module.__getattribute__(model_id)(weights="DEFAULT")
         except ImportError:
             logging.error("Model {} not found".format(model_id))
+            raise
     else:
         raise ImportError
 
 
-def classify_image(model_id, img_id, fetch_image=fetch_image):
-    """Returns the top-5 classification score output from the
-    model specified in model_id when it is fed with the
-    image corresponding to img_id."""
-    img = fetch_image(img_id)
+_model_locks = {model_id: threading.Lock() for model_id in conf.models}
+
+
+def load_cached_model(cache, model_id, build):
+    """Returns cache[model_id], building it with build(model_id) on first
+    use. Cached models are returned without locking; a build only holds
+    the lock of its own model, so it neither blocks the other models nor
+    runs twice for the same one. Failed builds are not cached."""
+    model = cache.get(model_id)
+    if model is not None:
+        return model
+    if model_id not in conf.models:
+        raise ImportError
+    with _model_locks[model_id]:
+        model = cache.get(model_id)
+        if model is None:
+            model = build(model_id)
+            cache[model_id] = model
+    return model
+
+
+def _build_model(model_id):
+    if os.path.exists(artifact_path(model_id)):
+        return torch.export.load(artifact_path(model_id)).module()
     model = get_model(model_id)
     model.eval()
+    return model
+
+
+_models = {}
+
+
+def load_model(model_id):
+    """Returns the model used for classification, ready for inference.
+    The exported program written by prepare_models.py is loaded when
+    available, otherwise the model is built with get_model. Models are
+    loaded once and then shared between requests."""
+    return load_cached_model(_models, model_id, _build_model)
+
+
+def warm_up_models(runs=3):
+    """Loads every model of the configuration and runs it a few times on
+    a blank image, so that the first requests do not pay for loading the
+    model and for the lazy initializations of torch. Returns the latency
+    of the last run of every model that could be loaded."""
+    example = torch.zeros(1, 3, 224, 224)
+    latencies = {}
+    for model_id in conf.models:
+        try:
+            model = load_model(model_id)
+            with torch.no_grad():
+                for _ in range(runs):
+                    start = time.perf_counter()
+                    model(example)
+            latencies[model_id] = time.perf_counter() - start
+        except Exception:
+            logging.exception("Warm-up of model {} failed".format(model_id))
+    return latencies
+
+
+def preprocess_image(img):
+    """Converts a Pillow image into the normalized batch tensor
+    expected by the Imagenet models."""
     transform = transforms.Compose(
         (
             transforms.Resize(256),
@@ -68,13 +127,23 @@ def classify_image(model_id, img_id, fetch_image=fetch_image):
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
         )
     )
+    img = img.convert("RGB")
+    return transform(img).unsqueeze(0)
+
+
+def classify_image(model_id, img_id, fetch_image=fetch_image):
+    """Returns the top-5 classification score output from the
+    model specified in model_id when it is fed with the
+    image corresponding to img_id."""
+    img = fetch_image(img_id)
+    model = load_model(model_id)
 
     # apply transform from torchvision
-    img = img.convert("RGB")
-    preprocessed = transform(img).unsqueeze(0)
+    preprocessed = preprocess_image(img)
 
     # gets the output from the model
-    out = model(preprocessed)
+    with torch.no_grad():
+        out = model(preprocessed)
     _, indices = torch.sort(out, descending=True)
 
     # transforms scores as percentages
@@ -89,3 +158,22 @@ def classify_image(model_id, img_id, fetch_image=fetch_image):
 
     img.close()
     return output
+
+
+def extract_features(model, images):
+    """Returns the penultimate-layer features of the model for a list
+    of Pillow images, as a (len(images), dim) tensor. The features are
+    the input of the last fully connected layer, captured with a hook
+    so that the same code works for every backbone in the configuration."""
+    last_linear = [m for m in model.modules() if isinstance(m, torch.nn.Linear)][-1]
+    features = []
+    handle = last_linear.register_forward_pre_hook(
+        lambda module, inputs: features.append(inputs[0].detach())
+    )
+    try:
+        batch = torch.cat([preprocess_image(img) for img in images])
+        with torch.no_grad():
+            model(batch)
+    finally:
+        handle.remove()
+    return torch.flatten(features[-1], start_dim=1)
@@ -0,0 +1,255 @@
+"""
+Similar-image search over the gallery. The penultimate-layer features of
+the classification models are L2-normalized and stored, once per model,
+in a memory-mapped float16 matrix. Queries are answered with a vectorized
+cosine-similarity search, optionally restricted to the closest lists of
+an IVF (inverted file) partition of the gallery.
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+import numpy as np
+
+from app.config import Configuration
+from app.ml.classification_utils import extract_features
+from app.ml.classification_utils import fetch_image
+from app.ml.classification_utils import fetch_image_bytes
+from app.ml.classification_utils import get_model
+from app.ml.classification_utils import load_cached_model
+from app.utils import get_manifest, list_images
+
+conf = Configuration()
+
+# rows scored per step in the exact search, bounds the float32 copy
+SEARCH_CHUNK = 65536
+
+
+def _index_dir(model_id):
+    return os.path.join(conf.index_folder_path, model_id)
+
+
+def _normalize(x):
+    """L2-normalizes the rows of x, leaving all-zero rows untouched."""
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+def _kmeans(x, nlist, n_iter=20, seed=0):
+    """Spherical k-means on the normalized rows of x. Returns the
+    normalized centroids and the list assignment of every row."""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), nlist, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        non_empty = np.bincount(assign, minlength=nlist) > 0
+        centroids[non_empty] = _normalize(sums[non_empty])
+    assign = np.argmax(x @ centroids.T, axis=1)
+    return centroids, assign
+
+
+def _gallery_fingerprint(image_ids):
+    """Returns a digest of the gallery images, including their hashes
+    from the manifest when available, used to detect a stale index."""
+    manifest = get_manifest() or {}
+    digest = hashlib.sha256()
+    for image_id in sorted(image_ids):
+        digest.update(image_id.encode("utf-8"))
+        digest.update(manifest.get(image_id, {}).get("sha256", "").encode("utf-8"))
+    return digest.hexdigest()
+
+
+def build_index(model_id, nlist=conf.index_nlist, batch_size=conf.index_batch_size):
+    """Computes the embeddings of every gallery image with the model
+    specified in model_id and stores them in the index folder. If nlist
+    is positive, the rows are grouped by IVF list so that every list is
+    a contiguous slice of the memory-mapped matrix.
+
+    The arrays of every build are written under a new name and ids.json,
+    which points to them, is replaced last, so a reader always sees the
+    ids and the embeddings of the same build."""
+    image_ids = list_images()
+    if not image_ids:
+        raise FileNotFoundError("No images found, run prepare_images.py first")
+    model = get_model(model_id)
+    model.eval()
+
+    index_dir = _index_dir(model_id)
+    os.makedirs(index_dir, exist_ok=True)
+    build = uuid.uuid4().hex[:12]
+    embeddings_name = f"embeddings-{build}.npy"
+    embeddings_path = os.path.join(index_dir, embeddings_name)
+
+    embeddings = None
+    for start in range(0, len(image_ids), batch_size):
+        batch_ids = image_ids[start:start + batch_size]
+        images = [fetch_image(image_id) for image_id in batch_ids]
+        features = extract_features(model, images).numpy()
+        for img in images:
+            img.close()
+        if embeddings is None:
+            embeddings = np.lib.format.open_memmap(
+                embeddings_path, mode="w+", dtype=np.float16,
+                shape=(len(image_ids), features.shape[1]),
+            )
+        embeddings[start:start + len(batch_ids)] = _normalize(features)
+    embeddings.flush()
+    del embeddings
+
+    meta = {
+        "gallery": _gallery_fingerprint(image_ids),
+        "embeddings": embeddings_name,
+        "centroids": None,
+        "offsets": None,
+    }
+    nlist = min(nlist, len(image_ids))
+    if nlist > 0:
+        x = np.load(embeddings_path).astype(np.float32)
+        centroids, assign = _kmeans(x, nlist)
+        order = np.argsort(assign, kind="stable")
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=nlist))))
+        np.save(embeddings_path, x[order].astype(np.float16))
+        meta["centroids"] = f"centroids-{build}.npy"
+        meta["offsets"] = f"offsets-{build}.npy"
+        np.save(os.path.join(index_dir, meta["centroids"]), centroids)
+        np.save(os.path.join(index_dir, meta["offsets"]), offsets)
+        image_ids = [image_ids[i] for i in order]
+    meta["ids"] = image_ids
+
+    ids_path = os.path.join(index_dir, "ids.json")
+    with open(ids_path + ".part", "w") as f:
+        json.dump(meta, f)
+    os.replace(ids_path + ".part", ids_path)
+
+    # arrays of previous builds are no longer referenced
+    current = {meta["embeddings"], meta["centroids"], meta["offsets"]}
+    for name in os.listdir(index_dir):
+        if name.endswith(".npy") and name not in current:
+            os.remove(os.path.join(index_dir, name))
+
+    logging.info(f"Index for {model_id} stored in {index_dir}.")
+
+
+class GalleryIndex:
+    """Read-only view over the stored embeddings of one model."""
+
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, "ids.json")) as f:
+            meta = json.load(f)
+        self.ids = meta["ids"]
+        self.rows = {image_id: row for row, image_id in enumerate(self.ids)}
+        self.embeddings = np.load(os.path.join(index_dir, meta["embeddings"]), mmap_mode="r")
+        if len(self.ids) != self.embeddings.shape[0]:
+            raise ValueError(f"Corrupted index in {index_dir}, run prepare_index.py again")
+        if meta["gallery"] != _gallery_fingerprint(list_images()):
+            raise ValueError(f"Index in {index_dir} is out of date, run prepare_index.py again")
+        if meta["centroids"] is not None:
+            self.centroids = np.load(os.path.join(index_dir, meta["centroids"]))
+            self.offsets = np.load(os.path.join(index_dir, meta["offsets"]))
+        else:
+            self.centroids = None
+            self.offsets = None
+
+    def _candidates(self, query, nprobe):
+        """Yields (first_row, scores) for the slices of the gallery that
+        have to be scored against the query."""
+        if self.centroids is None:
+            slices = [(s, min(s + SEARCH_CHUNK, len(self.ids)))
+                      for s in range(0, len(self.ids), SEARCH_CHUNK)]
+        else:
+            lists = np.argsort(self.centroids @ query)[::-1][:nprobe]
+            slices = [(self.offsets[i], self.offsets[i + 1]) for i in lists]
+        for start, stop in slices:
+            if stop > start:
+                yield start, self.embeddings[start:stop].astype(np.float32) @ query
+
+    def search(self, query, k, nprobe=conf.index_nprobe, exclude=None):
+        """Returns the k gallery images closest to the query vector as
+        a list of [image_id, cosine similarity] sorted by similarity."""
+        query = _normalize(np.asarray(query, dtype=np.float32))
+        rows, scores = [], []
+        for start, chunk_scores in self._candidates(query, nprobe):
+            rows.append(np.arange(start, start + len(chunk_scores)))
+            scores.append(chunk_scores)
+        if not rows:
+            return []
+        rows = np.concatenate(rows)
+        scores = np.concatenate(scores)
+        if exclude in self.rows:
+            scores[rows == self.rows[exclude]] = -np.inf
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [[self.ids[rows[i]], float(scores[i])] for i in top if np.isfinite(scores[i])]
+
+
+def _gallery_mtime():
+    """Returns the modification time of the gallery manifest or, if there
+    is none, of the gallery folder, which changes with its images."""
+    manifest_path = os.path.join(conf.image_folder_path, conf.manifest_name)
+    try:
+        return os.stat(manifest_path).st_mtime_ns
+    except OSError:
+        return os.stat(conf.image_folder_path).st_mtime_ns
+
+
+@functools.lru_cache(maxsize=len(conf.models))
+def _read_index(index_dir, ids_mtime, gallery_mtime):
+    return GalleryIndex(index_dir)
+
+
+def load_index(model_id):
+    """Returns the stored index of the model specified in model_id. The
+    index is cached until ids.json or the gallery change, so a running
+    server picks up a new build and reports a gallery out of date."""
+    if model_id not in conf.models:
+        raise ImportError
+    index_dir = _index_dir(model_id)
+    try:
+        ids_mtime = os.stat(os.path.join(index_dir, "ids.json")).st_mtime_ns
+    except OSError:
+        raise FileNotFoundError(
+            f"No index for {model_id}, run prepare_index.py first"
+        )
+    return _read_index(index_dir, ids_mtime, _gallery_mtime())
+
+
+def find_similar_images(model_id, image_id, k=conf.similar_top_k):
+    """Returns the k gallery images most similar to the gallery image
+    image_id. The stored embedding is reused, so no model is run."""
+    index = load_index(model_id)
+    if image_id not in index.rows:
+        raise FileNotFoundError(f"Image {image_id} not found")
+    query = index.embeddings[index.rows[image_id]]
+    return index.search(query, k, exclude=image_id)
+
+
+def _build_feature_model(model_id):
+    model = get_model(model_id)
+    model.eval()
+    return model
+
+
+_feature_models = {}
+
+
+def get_feature_model(model_id):
+    """Returns the eager model used to embed uploaded images. Unlike the
+    exported classification models it keeps its modules, which
+    extract_features hooks into. It is built once and then shared."""
+    return load_cached_model(_feature_models, model_id, _build_feature_model)
+
+
+def find_similar_upload(model_id, bytes_img, k=conf.similar_top_k):
+    """Returns the k gallery images most similar to an uploaded image."""
+    index = load_index(model_id)
+    model = get_feature_model(model_id)
+    img = fetch_image_bytes(bytes_img)
+    query = extract_features(model, [img])[0].numpy()
+    img.close()
+    return index.search(query, k)
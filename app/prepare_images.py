@@ -1,53 +1,228 @@
+import argparse
+import hashlib
 import json
 import logging
 import os
 import shutil
-from io import BytesIO
-from urllib.request import urlopen
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import Request, url2pathname, urlopen
 from zipfile import ZipFile
 
-import requests
+from PIL import Image
 
 from config import Configuration
 
+CHUNK_SIZE = 1 << 20
+IMAGE_EXTENSIONS = (".jpeg", ".jpg", ".png")
 
-def prepare_images():
-    """Downloads a subset of the Imagenet Dataset."""
-    img_folder = Configuration().image_folder_path
-    if not os.path.exists(img_folder):
-        zip_url = (
-            "https://github.com/EliSchwartz/"
-            "imagenet-sample-images/archive/master.zip"
-        )
-        with urlopen(zip_url) as zipresp:
-            with ZipFile(BytesIO(zipresp.read())) as zfile:
-                zfile.extractall(img_folder)
-    sub_dir = os.path.join(img_folder, "imagenet-sample-images-master")
-    if os.path.exists(sub_dir):
-        files = os.listdir(sub_dir)
-        for f in files:
-            shutil.move(os.path.join(sub_dir, f), img_folder)
-        shutil.rmtree(sub_dir)
+
+def _local_path(url):
+    """Returns the local path pointed to by url, or None if it is remote."""
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        return url2pathname(parsed.path)
+    if parsed.scheme in ("http", "https", "ftp"):
+        return None
+    return url
+
+
+def _content_range(header):
+    """Parses a "bytes start-end/total" header into (start, total), the
+    total being None when unknown."""
+    unit_range, _, total = header.partition("/")
+    start = int(unit_range.split()[-1].split("-")[0])
+    return start, None if total == "*" else int(total)
+
+
+def cache_path(url, filename):
+    """Returns the path of the download of url in the download cache. The
+    name includes a hash of the URL, so another mirror or archive is never
+    mistaken for a previous download."""
+    url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(Configuration.download_cache_path, f"{url_hash}-{filename}")
+
+
+def download(url, dest_path, chunk_size=CHUNK_SIZE, force=False):
+    """Downloads url to dest_path streaming it in chunks. A partial
+    download left in dest_path + ".part" is resumed with a range request
+    only if the server confirms, through If-Range, that the file did not
+    change since. A complete download is reused unless force is set.
+    Local paths are used in place."""
+    local_path = _local_path(url)
+    if local_path is not None:
+        return local_path
+    if force:
+        for path in (dest_path, dest_path + ".part", dest_path + ".part.json"):
+            if os.path.exists(path):
+                os.remove(path)
+    if os.path.exists(dest_path):
+        return dest_path
+
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    part_path = dest_path + ".part"
+    meta_path = dest_path + ".part.json"
+    # ETag or Last-Modified of the file the partial download comes from
+    validator = None
+    if os.path.exists(part_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            validator = json.load(f).get("validator")
+    offset = os.path.getsize(part_path) if validator else 0
+
+    request = Request(url)
+    if offset:
+        request.add_header("Range", f"bytes={offset}-")
+        request.add_header("If-Range", validator)
+    try:
+        with urlopen(request) as resp:
+            if offset and resp.status == 206:
+                start, total = _content_range(resp.headers["Content-Range"])
+                if start != offset:
+                    raise OSError(f"Unexpected range {start} resuming {url}")
+                mode = "ab"
+            else:
+                # new or changed file, the server answered with all of it
+                length = resp.headers.get("Content-Length")
+                total = int(length) if length is not None else None
+                etag = resp.headers.get("ETag")
+                validator = etag if etag and not etag.startswith("W/") else resp.headers.get("Last-Modified")
+                with open(meta_path, "w") as f:
+                    json.dump({"url": url, "validator": validator}, f)
+                mode = "wb"
+            with open(part_path, mode) as f:
+                shutil.copyfileobj(resp, f, chunk_size)
+    except HTTPError as e:
+        if not (offset and e.code == 416):
+            raise
+        # the partial download does not fit the remote file, start over
+        os.remove(part_path)
+        os.remove(meta_path)
+        return download(url, dest_path, chunk_size)
+
+    size = os.path.getsize(part_path)
+    if total is not None and size != total:
+        if size > total:
+            os.remove(part_path)
+        raise OSError(f"Incomplete download of {url}: {size} of {total} bytes")
+    os.replace(part_path, dest_path)
+    os.remove(meta_path)
+    logging.info(f"{url} downloaded to {dest_path}.")
+    return dest_path
+
+
+def _extract_member(open_archive, member, img_folder):
+    """Extracts a single image of the archive in img_folder and returns
+    its manifest entry. Images already extracted are only re-read.
+    open_archive returns the ZipFile handle of the calling thread."""
+    name = os.path.basename(member.filename)
+    dest_path = os.path.join(img_folder, name)
+    if not (os.path.exists(dest_path) and os.path.getsize(dest_path) == member.file_size):
+        with open_archive().open(member) as src:
+            with open(dest_path + ".part", "wb") as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.replace(dest_path + ".part", dest_path)
+
+    sha256 = hashlib.sha256()
+    with open(dest_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    with Image.open(dest_path) as img:
+        width, height = img.size
+    return name, {
+        "size": member.file_size,
+        "width": width,
+        "height": height,
+        "sha256": sha256.hexdigest(),
+    }
+
+
+def extract_images(archive_path, img_folder, workers=None):
+    """Extracts the images of the archive in img_folder in parallel and
+    writes the gallery manifest with their size, dimensions and hash."""
+    os.makedirs(img_folder, exist_ok=True)
+    with ZipFile(archive_path) as zfile:
+        members = [
+            m for m in zfile.infolist()
+            if not m.is_dir() and m.filename.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+
+    # ZipFile reads are not thread-safe, every worker opens the archive
+    # once and reuses its handle for all of its members
+    local = threading.local()
+    handles = []
+
+    def open_archive():
+        if not hasattr(local, "zfile"):
+            local.zfile = ZipFile(archive_path)
+            handles.append(local.zfile)
+        return local.zfile
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            entries = executor.map(
+                lambda m: _extract_member(open_archive, m, img_folder), members
+            )
+            manifest = dict(entries)
+    finally:
+        for zfile in handles:
+            zfile.close()
+
+    manifest_path = os.path.join(img_folder, Configuration.manifest_name)
+    with open(manifest_path + ".part", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + ".part", manifest_path)
+    logging.info(f"Manifest of {len(manifest)} images stored in {manifest_path}.")
+
+
+def prepare_images(archive_url=Configuration.images_archive_url, workers=None, force=False):
+    """Downloads a subset of the Imagenet Dataset. The preparation is
+    skipped once the gallery manifest exists, unless force is set."""
+    conf = Configuration()
+    img_folder = conf.image_folder_path
+    manifest_path = os.path.join(img_folder, conf.manifest_name)
+    if os.path.exists(manifest_path) and not force:
+        logging.info(f"Images already prepared in {img_folder}.")
+        return
+    archive_path = download(
+        archive_url, cache_path(archive_url, "imagenet-sample-images.zip"), force=force
+    )
+    extract_images(archive_path, img_folder, workers)
     logging.info(f"Images downloaded and stored in {img_folder}.")
 
 
-def prepare_labels():
+def prepare_labels(labels_url=Configuration.labels_url, force=False):
     """Saves a JSON file containing Imagenet labels as a list where
     the index is the label ID of the class."""
-    img_folder = Configuration().image_folder_path
-    labels_path = os.path.join(img_folder, "imagenet_labels.json")
-    imagenet_labels_path = (
-        "https://raw.githubusercontent.com/"
-        "anishathalye/imagenet-simple-labels/"
-        "master/imagenet-simple-labels.json"
+    conf = Configuration()
+    labels_path = os.path.join(conf.image_folder_path, "imagenet_labels.json")
+    if os.path.exists(labels_path) and not force:
+        logging.info(f"Labels already stored in {labels_path}.")
+        return
+    source_path = download(
+        labels_url, cache_path(labels_url, "imagenet_labels.json"), force=force
     )
-    r = requests.get(imagenet_labels_path)
-    data = r.json()
+    with open(source_path) as f:
+        data = json.load(f)
+    os.makedirs(conf.image_folder_path, exist_ok=True)
     with open(labels_path, "w") as f:
         json.dump(data, f)
     logging.info(f"Labels downloaded and stored in {labels_path}.")
 
 
 if __name__ == "__main__":
-    prepare_images()
-    prepare_labels()
+    parser = argparse.ArgumentParser(description=prepare_images.__doc__)
+    parser.add_argument("--archive", default=Configuration.images_archive_url,
+                        help="URL or local path of the images zip archive")
+    parser.add_argument("--labels", default=Configuration.labels_url,
+                        help="URL or local path of the labels JSON file")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of parallel extraction workers")
+    parser.add_argument("--force", action="store_true",
+                        help="prepare again even if already prepared")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    prepare_images(args.archive, args.workers, args.force)
+    prepare_labels(args.labels, args.force)
@@ -0,0 +1,21 @@
+import logging
+
+from app.config import Configuration
+from app.ml.similarity_utils import build_index
+
+conf = Configuration()
+
+
+def prepare_index():
+    """Builds the similar-image index of the gallery for the models
+    specified in the configuration object."""
+    for model_name in conf.models:
+        try:
+            build_index(model_name)
+        except ImportError:
+            logging.error("Model {} not found".format(model_name))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    prepare_index()
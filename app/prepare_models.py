@@ -1,22 +1,129 @@
+import argparse
 import importlib
+import json
 import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
 
-from config import Configuration
+import torch
+from torch.fx.experimental.optimization import fuse
+
+from config import Configuration, artifact_path
 
 conf = Configuration()
 
 
-def prepare_models():
-    """Pre-downloads the models specified in the configuration object."""
+def export_model(model, path):
+    """Exports the model with torch.export and saves the exported program.
+    The batch norm layers are folded into the preceding convolutions
+    first, so the server only has to load a ready-to-run graph."""
+    model.eval()
+    # a batch of 1 would be specialized by the export, the batch size is
+    # kept dynamic
+    example = torch.zeros(2, 3, 224, 224)
+    with torch.no_grad():
+        fused = fuse(model)
+        exported = torch.export.export(
+            fused, (example,), dynamic_shapes=({0: torch.export.Dim("batch", max=1024)},)
+        )
+        # check that the artifact gives the same output as the model
+        torch.testing.assert_close(
+            exported.module()(example), model(example), rtol=1e-3, atol=1e-3
+        )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".part", "wb") as f:
+        torch.export.save(exported, f)
+    os.replace(path + ".part", path)
+
+
+def prepare_models(export=True):
+    """Pre-downloads the models specified in the configuration object
+    and, if export is set, writes their precompiled artifacts."""
     for model_name in conf.models:
         try:
             module = importlib.import_module("torchvision.models")
             # download model
-            _ = module.__getattribute__(model_name)(weights="DEFAULT")
-            del _  # free up memory
+            model = module.__getattribute__(model_name)(weights="DEFAULT")
         except ImportError:
             logging.error("Model {} not found".format(model_name))
+            continue
+        if export:
+            path = artifact_path(model_name)
+            try:
+                export_model(model, path)
+                logging.info(f"Artifact of {model_name} stored in {path}.")
+            except Exception:
+                # the server falls back to the torchvision model
+                logging.exception("Export of model {} failed".format(model_name))
+        del model  # free up memory
+
+
+def measure_model(model_name, source):
+    """Returns the load time and the latency of the first request of the
+    model, built from torchvision or loaded from its artifact. It is meant
+    to run in a fresh process, see benchmark_models. The modules used by
+    both paths are imported before the clock starts, as the server imports
+    them anyway."""
+    module = importlib.import_module("torchvision.models")
+    importlib.import_module("torch.export")
+    example = torch.rand(1, 3, 224, 224)
+    start = time.perf_counter()
+    if source == "torchvision":
+        model = module.__getattribute__(model_name)(weights="DEFAULT").eval()
+    else:
+        model = torch.export.load(artifact_path(model_name)).module()
+    loaded = time.perf_counter()
+    with torch.no_grad():
+        model(example)
+    first = time.perf_counter()
+    return {"load": loaded - start, "first_request": first - loaded}
+
+
+def benchmark_models(repeats=5):
+    """Logs, for every model, the median cold-load time and latency of
+    the first request when the model is built from torchvision and when
+    it is loaded from its precompiled artifact. Every measurement runs in
+    a fresh process, alternating the two sources, so that neither path
+    benefits from the setup done by the other."""
+    results = {}
+    for model_name in conf.models:
+        samples = {"torchvision": [], "artifact": []}
+        for i in range(repeats):
+            sources = list(samples) if i % 2 == 0 else list(samples)[::-1]
+            for source in sources:
+                out = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--measure", model_name, source],
+                    check=True, capture_output=True, text=True,
+                ).stdout
+                samples[source].append(json.loads(out.splitlines()[-1]))
+        results[model_name] = {}
+        for source, runs in samples.items():
+            load = statistics.median(run["load"] for run in runs)
+            first = statistics.median(run["first_request"] for run in runs)
+            results[model_name][source] = {"load": load, "first_request": first}
+            logging.info(
+                f"{model_name} ({source}): load {load:.3f}s, first request {first:.3f}s"
+            )
+    return results
 
 
 if __name__ == "__main__":
-    prepare_models()
+    parser = argparse.ArgumentParser(description=prepare_models.__doc__)
+    parser.add_argument("--no-export", action="store_true",
+                        help="only download the models")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="compare load and first-request times of the artifacts")
+    parser.add_argument("--measure", nargs=2, metavar=("MODEL", "SOURCE"),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure_model(*args.measure)))
+        sys.exit()
+    logging.basicConfig(level=logging.INFO)
+    prepare_models(export=not args.no_export)
+    if args.benchmark:
+        benchmark_models()
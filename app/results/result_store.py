@@ -0,0 +1,149 @@
+"""
+Server-side store for classification results. Results are kept under a
+short id for a limited time so that the download endpoints can serve the
+pre-serialized JSON and the rendered PNG chart without the client sending
+the scores back. The in-memory store is bounded and can be backed by a
+SQLite file so that results survive restarts and are shared by workers.
+"""
+import io
+import json
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from matplotlib.figure import Figure
+
+from app.config import Configuration
+
+conf = Configuration()
+
+
+def render_scores_png(classification_scores):
+    """Renders the classification scores as a bar chart and returns
+    the PNG bytes."""
+    labels = [item[0] for item in classification_scores]
+    data = [item[1] for item in classification_scores]
+
+    # a Figure is used instead of pyplot as its global state is not
+    # safe to share between the threads serving requests
+    fig = Figure()
+    ax = fig.subplots()
+    ax.barh(
+        labels,
+        data,
+        color=["#1a4a04", "#750014", "#795703", "#06216c", "#3f0355"],
+    )
+    ax.grid()
+    ax.set_title("Classification Scores")
+    ax.invert_yaxis()
+
+    img_buffer = io.BytesIO()
+    fig.tight_layout()
+    fig.savefig(img_buffer, format="png")
+    return img_buffer.getvalue()
+
+
+class ResultStore:
+    """Bounded TTL store mapping result ids to serialized results."""
+
+    def __init__(self, max_entries=conf.result_store_size,
+                 ttl=conf.result_ttl_seconds, db_path=conf.result_store_db,
+                 clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        # result_id -> [expires, json_bytes, png_bytes or None]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(id TEXT PRIMARY KEY, expires REAL, json BLOB, png BLOB)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS results_expires ON results (expires)"
+            )
+            self._db.commit()
+
+    def put(self, classification_scores):
+        """Stores the classification scores and returns their result id."""
+        result_id = secrets.token_urlsafe(8)
+        expires = self.clock() + self.ttl
+        json_bytes = json.dumps(classification_scores, indent=2).encode("utf-8")
+        with self._lock:
+            self._entries[result_id] = [expires, json_bytes, None]
+            self._evict()
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT INTO results VALUES (?, ?, ?, NULL)",
+                    (result_id, expires, json_bytes),
+                )
+                # the table is bounded like the memory, the entries that
+                # expire first are dropped
+                self._db.execute(
+                    "DELETE FROM results WHERE expires < ? OR id NOT IN "
+                    "(SELECT id FROM results ORDER BY expires DESC LIMIT ?)",
+                    (self.clock(), self.max_entries),
+                )
+                self._db.commit()
+        return result_id
+
+    def _evict(self):
+        """Drops the expired entries and the oldest ones above the size
+        bound. All the entries have the same TTL, so they are stored in
+        expiry order and the scan stops at the first live entry."""
+        now = self.clock()
+        while self._entries:
+            expires = next(iter(self._entries.values()))[0]
+            if expires >= now and len(self._entries) <= self.max_entries:
+                break
+            self._entries.popitem(last=False)
+
+    def _get(self, result_id):
+        """Returns the entry of result_id, or None if unknown or expired.
+        Must be called with the lock held."""
+        entry = self._entries.get(result_id)
+        if entry is None and self._db is not None:
+            row = self._db.execute(
+                "SELECT expires, json, png FROM results WHERE id = ?", (result_id,)
+            ).fetchone()
+            if row is not None:
+                entry = [row[0], bytes(row[1]), row[2] and bytes(row[2])]
+                self._entries[result_id] = entry
+                self._evict()
+        if entry is None or entry[0] < self.clock():
+            return None
+        return entry
+
+    def get_json(self, result_id):
+        """Returns the serialized JSON of result_id and its expiry time."""
+        with self._lock:
+            entry = self._get(result_id)
+        if entry is None:
+            raise KeyError(result_id)
+        return entry[1], entry[0]
+
+    def get_png(self, result_id):
+        """Returns the bar chart of result_id as PNG bytes and its expiry
+        time. The chart is rendered on first access and then cached."""
+        with self._lock:
+            entry = self._get(result_id)
+        if entry is None:
+            raise KeyError(result_id)
+        if entry[2] is None:
+            png_bytes = render_scores_png(json.loads(entry[1]))
+            with self._lock:
+                entry[2] = png_bytes
+                if self._db is not None:
+                    self._db.execute(
+                        "UPDATE results SET png = ? WHERE id = ?", (png_bytes, result_id)
+                    )
+                    self._db.commit()
+        return entry[2], entry[0]
+
+
+result_store = ResultStore()
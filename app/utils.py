@@ -1,3 +1,5 @@
+import functools
+import json
 import os
 
 from app.config import Configuration
@@ -5,8 +7,28 @@ from app.config import Configuration
 conf = Configuration()
 
 
+@functools.lru_cache(maxsize=1)
+def _read_manifest(manifest_path, mtime):
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def get_manifest():
+    """Returns the gallery manifest written by prepare_images.py, mapping
+    every image to its size, dimensions and hash, or None if missing."""
+    manifest_path = os.path.join(conf.image_folder_path, conf.manifest_name)
+    try:
+        mtime = os.path.getmtime(manifest_path)
+    except OSError:
+        return None
+    return _read_manifest(manifest_path, mtime)
+
+
 def list_images():
     """Returns the list of available images."""
+    manifest = get_manifest()
+    if manifest is not None:
+        return list(manifest)
     img_names = filter(
         lambda x: x.endswith(".JPEG"), os.listdir(conf.image_folder_path)
     )
@@ -1,26 +1,48 @@
+import functools
 import json
+import time
+from contextlib import asynccontextmanager
+
+import anyio
 from fastapi import FastAPI, Request, BackgroundTasks, HTTPException
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from app.config import Configuration
 from app.forms.classification_form import ClassificationForm
 from app.forms.classification_upload_form import ClassificationUploadForm
 from app.forms.histogram_form import HistogramForm
+from app.forms.similarity_form import SimilarityForm
 from app.histogram.histogram_utils import histogram_hub
-from app.ml.classification_utils import classify_image
+from app.ml.admission_control import Overloaded, admission_controller, timed
+from app.ml.classification_utils import classify_image, warm_up_models
+from app.ml.classification_utils import fetch_image
 from app.ml.classification_utils import fetch_image_bytes
+from app.ml.similarity_utils import find_similar_images, find_similar_upload
+from app.results.result_store import result_store
 from app.utils import list_images
 from app.forms.transformation_form import TransformForm
 from app.ml.transformation_utils import transform_image, cleanup_transforms
 
-import io
 import base64
-import matplotlib.pyplot as plt
 
-app = FastAPI()
 config = Configuration()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Loads and warms up the models before serving requests, so that the
+    first classification does not pay for it and its latency does not
+    skew the estimates of the admission controller, which are seeded
+    with the warm latencies instead."""
+    latencies = await run_in_threadpool(warm_up_models)
+    admission_controller.seed(latencies)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
 
@@ -41,6 +63,46 @@ def home(request: Request):
     return templates.TemplateResponse("home.html", {"request": request})
 
 
+@app.get("/metrics")
+def metrics() -> dict:
+    """Returns the state and the policy decisions of the admission
+    controller of the classification endpoints."""
+    return admission_controller.metrics()
+
+
+# bounds the classifications running at once, as assumed by the
+# admission controller, the other requests wait for a free worker
+classification_limiter = anyio.CapacityLimiter(config.classification_concurrency)
+
+
+async def classify_admitted(model_id, img_id, allow_fallback, fetch_image=fetch_image):
+    """Classifies the image through the admission controller, in a worker
+    thread so that the queue of requests can build up and be measured.
+    Returns the id of the model that answered and the scores, or raises
+    a 429 error if the request is shed."""
+    if model_id not in Configuration.models:
+        raise HTTPException(status_code=400, detail="A valid model id is required")
+    try:
+        with admission_controller.admit(model_id, allow_fallback) as served_id:
+            # timed in the worker, the wait for a free worker is not part
+            # of the latency of the model
+            classification_scores, elapsed = await anyio.to_thread.run_sync(
+                functools.partial(
+                    timed, classify_image,
+                    model_id=served_id, img_id=img_id, fetch_image=fetch_image,
+                ),
+                limiter=classification_limiter,
+            )
+    except Overloaded as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    admission_controller.observe(served_id, elapsed)
+    return served_id, classification_scores
+
+
 @app.get("/classifications")
 def create_classify(request: Request):
     return templates.TemplateResponse(
@@ -55,14 +117,20 @@ async def request_classification(request: Request):
     await form.load_data()
     image_id = form.image_id
     model_id = form.model_id
-    classification_scores = classify_image(model_id=model_id, img_id=image_id)
+    served_id, classification_scores = await classify_admitted(
+        model_id, image_id, form.allow_fallback
+    )
     return templates.TemplateResponse(
         "classification_output.html",
         {
             "request": request,
             "image_id": image_id,
+            "requested_model_id": model_id,
+            "model_id": served_id,
             "classification_scores": json.dumps(classification_scores),
+            "result_id": await run_in_threadpool(result_store.put, classification_scores),
         },
+        headers={"X-Served-Model": served_id},
     )
 
 
@@ -115,7 +183,9 @@ async def request_classification_upload(request: Request):
         model_id = form.model_id
 
         # Classify the image using raw bytes instead of a file, utilizing fetch_image_bytes to process the input
-        classification_scores = classify_image(model_id=model_id, img_id=bytes_img, fetch_image=fetch_image_bytes)
+        served_id, classification_scores = await classify_admitted(
+            model_id, bytes_img, form.allow_fallback, fetch_image=fetch_image_bytes
+        )
 
         # Encode the image in Base64 to embed it directly in the HTML template
         b64_img = base64.b64encode(bytes_img).decode('utf-8')
@@ -127,8 +197,12 @@ async def request_classification_upload(request: Request):
             {
                 "request": request,
                 "image_base64": b64_img,
+                "requested_model_id": model_id,
+                "model_id": served_id,
                 "classification_scores": classification_scores,
+                "result_id": await run_in_threadpool(result_store.put, classification_scores),
             },
+            headers={"X-Served-Model": served_id},
         )
     else:
         # if the form is not valid, then return the home page template
@@ -235,62 +309,135 @@ async def request_histogram(request: Request):
         }
     )
 
-@app.get("/download/json")
-async def download_json(scores: str):
+@app.get("/similar")
+def create_similar(request: Request):
+    return templates.TemplateResponse(
+        "similarity_select.html",
+        {"request": request, "images": list_images(), "models": Configuration.models},
+    )
+
+
+@app.post("/similar")
+async def request_similar(request: Request):
+    """
+    Shows the gallery images most similar to the selected gallery image,
+    according to the embeddings of the selected model.
+    """
+    form = SimilarityForm(request)
+    await form.load_data()
+
+    errors = form.errors if not form.is_valid() else []
+    if not errors:
+        try:
+            similar_images = await run_in_threadpool(
+                find_similar_images, form.model_id, form.image_id
+            )
+        except (FileNotFoundError, ImportError, ValueError) as e:
+            errors = [str(e) or "A valid model id is required"]
+    if errors:
+        return templates.TemplateResponse(
+            "similarity_select.html",
+            {
+                "request": request,
+                "images": list_images(),
+                "models": Configuration.models,
+                "errors": errors,
+            },
+            status_code=400,
+        )
+    return templates.TemplateResponse(
+        "similarity_output.html",
+        {
+            "request": request,
+            "image_id": form.image_id,
+            "model_id": form.model_id,
+            "similar_images": similar_images,
+        },
+    )
+
+
+@app.post("/similar-upload")
+async def request_similar_upload(request: Request):
+    """
+    Shows the gallery images most similar to an uploaded image.
+    """
+    form = ClassificationUploadForm(request)
+    await form.load_data()
+
+    errors = form.errors if not form.is_valid() else []
+    if not errors:
+        try:
+            similar_images = await run_in_threadpool(
+                find_similar_upload, form.model_id, form.image_bytes
+            )
+        except (FileNotFoundError, ImportError, ValueError) as e:
+            errors = [str(e) or "A valid model id is required"]
+    if errors:
+        return templates.TemplateResponse(
+            "similarity_select.html",
+            {
+                "request": request,
+                "images": list_images(),
+                "models": Configuration.models,
+                "errors": errors,
+            },
+            status_code=400,
+        )
+    return templates.TemplateResponse(
+        "similarity_output.html",
+        {
+            "request": request,
+            "image_base64": base64.b64encode(form.image_bytes).decode('utf-8'),
+            "model_id": form.model_id,
+            "similar_images": similar_images,
+        },
+    )
+
+
+def _download_response(request: Request, result_id: str, content: bytes,
+                       expires: float, media_type: str, filename: str):
+    """Builds the response of a download endpoint. Stored results never
+    change, so the result id is used as ETag and clients may cache the
+    file until the result expires."""
+    etag = f'"{result_id}"'
+    headers = {
+        "Cache-Control": f"private, max-age={max(int(expires - time.time()), 0)}, immutable",
+        "ETag": etag,
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return Response(content, media_type=media_type, headers=headers)
+
+
+@app.get("/download/json/{result_id}")
+def download_json(request: Request, result_id: str):
     """
     Returns classification scores as a downloadable JSON file.
     """
 
     try:
-        classification_scores = json.loads(scores)
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON data.")
-
-    scores_data = json.dumps(classification_scores, indent=2).encode("utf-8")
-    file_buffer = io.BytesIO(scores_data)
-
-    return StreamingResponse(
-        file_buffer,
-        media_type="application/json",
-        headers={
-            "Content-Disposition": "attachment; filename=classification_scores.json"
-        },
+        scores_data, expires = result_store.get_json(result_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Result not found or expired.")
+
+    return _download_response(
+        request, result_id, scores_data, expires,
+        "application/json", "classification_scores.json",
     )
 
 
-@app.get("/download/png")
-async def download_png(scores: str):
+@app.get("/download/png/{result_id}")
+def download_png(request: Request, result_id: str):
     """
     Returns classification scores as a downloadable bar chart (PNG).
     """
 
     try:
-        classification_scores = json.loads(scores)
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON data.")
-
-    labels = [item[0] for item in classification_scores]
-    data = [item[1] for item in classification_scores]
+        png_data, expires = result_store.get_png(result_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Result not found or expired.")
 
-    plt.barh(
-        labels,
-        data,
-        color=["#1a4a04", "#750014", "#795703", "#06216c", "#3f0355"],
+    return _download_response(
+        request, result_id, png_data, expires, "image/png", "top5_scores.png",
     )
-    plt.grid()
-    plt.title("Classification Scores")
-    plt.gca().invert_yaxis()
-
-    img_buffer = io.BytesIO()
-    plt.tight_layout()
-    plt.savefig(img_buffer, format="png")
-    img_buffer.seek(0)
-    plt.close()
-
-    return StreamingResponse(
-        img_buffer,
-        media_type="image/png",
-        headers={
-            "Content-Disposition": "attachment; filename=top5_scores.png"
-        },
-    )
\ No newline at end of file
@@ -0,0 +1,9 @@
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the app modules are imported as "app.*", the preparation scripts
+# are run from the app folder and import their siblings directly
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "app"))
@@ -0,0 +1,151 @@
+import time
+
+import anyio
+import pytest
+
+import main
+from app.ml.admission_control import AdmissionController, Overloaded
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def controller(clock):
+    return AdmissionController(
+        slo=1.0,
+        max_queue_depth=3,
+        concurrency=1,
+        fallback_models=("alexnet", "resnet18"),
+        priors={"resnet18": 0.2, "alexnet": 0.1, "vgg16": 0.6},
+        probe_interval=30.0,
+        clock=clock,
+    )
+
+
+def test_admits_within_slo(controller):
+    with controller.admit("vgg16") as served_id:
+        assert served_id == "vgg16"
+    assert controller.metrics()["decisions"] == {"admitted": {"vgg16": 1}}
+
+
+def test_always_admits_when_idle(controller):
+    controller.observe("vgg16", 3.0)
+    with controller.admit("vgg16") as served_id:
+        assert served_id == "vgg16"
+
+
+def test_rejects_when_slo_at_risk(controller):
+    with controller.admit("vgg16"):
+        with pytest.raises(Overloaded) as e:
+            with controller.admit("vgg16"):
+                pass
+    assert e.value.retry_after == 1
+    assert controller.metrics()["decisions"]["rejected"] == {"vgg16": 1}
+
+
+def test_degrades_to_cheapest_fallback(controller):
+    with controller.admit("vgg16"):
+        with controller.admit("vgg16", allow_fallback=True) as served_id:
+            assert served_id == "alexnet"
+    assert controller.metrics()["decisions"]["degraded"] == {"vgg16->alexnet": 1}
+
+
+def test_rejects_when_queue_is_full(controller):
+    with controller.admit("alexnet"), controller.admit("alexnet"), controller.admit("alexnet"):
+        with pytest.raises(Overloaded):
+            with controller.admit("alexnet", allow_fallback=True):
+                pass
+
+
+def test_seeds_estimates_with_priors(controller):
+    # the first burst is bounded by the prior, not only by the queue depth
+    assert controller.metrics()["latency_seconds"]["vgg16"] == 0.6
+    with controller.admit("resnet18"):
+        # models without a prior are expected to take the whole SLO
+        with pytest.raises(Overloaded):
+            with controller.admit("inception_v3"):
+                pass
+
+
+def test_failed_requests_leave_no_trace(controller):
+    with pytest.raises(FileNotFoundError):
+        with controller.admit("vgg16"):
+            raise FileNotFoundError
+    metrics = controller.metrics()
+    assert metrics["latency_seconds"]["vgg16"] == 0.6
+    assert metrics["in_flight"] == 0
+    assert metrics["pending_seconds"] == 0.0
+
+
+def test_recovers_with_probe_requests(controller, clock):
+    controller.observe("vgg16", 3.0)
+    with controller.admit("resnet18"):
+        with pytest.raises(Overloaded):
+            with controller.admit("vgg16"):
+                pass
+        clock.now = 31.0
+        with controller.admit("vgg16") as served_id:
+            assert served_id == "vgg16"
+            # a single probe at a time
+            with pytest.raises(Overloaded):
+                with controller.admit("vgg16"):
+                    pass
+        controller.observe("vgg16", 0.5)
+    assert controller.metrics()["decisions"]["probed"] == {"vgg16": 1}
+    assert controller.metrics()["latency_seconds"]["vgg16"] < 3.0
+
+
+def test_seed_replaces_estimates(controller):
+    controller.seed({"vgg16": 0.3})
+    assert controller.metrics()["latency_seconds"]["vgg16"] == 0.3
+
+
+def test_queue_wait_is_not_measured(controller, monkeypatch):
+    samples = []
+    monkeypatch.setattr(controller, "observe", lambda model_id, elapsed: samples.append(elapsed))
+    monkeypatch.setattr(controller, "slo", 10.0)
+    monkeypatch.setattr(main, "admission_controller", controller)
+    monkeypatch.setattr(main, "classification_limiter", anyio.CapacityLimiter(1))
+
+    def classify_image(model_id, img_id, fetch_image):
+        time.sleep(0.2)
+        return [[img_id, 100.0]]
+
+    monkeypatch.setattr(main, "classify_image", classify_image)
+
+    async def burst():
+        async with anyio.create_task_group() as tg:
+            for img_id in ("first", "second"):
+                tg.start_soon(main.classify_admitted, "alexnet", img_id, False)
+
+    start = time.perf_counter()
+    anyio.run(burst)
+    # the second request waited for the first one to free the worker
+    assert time.perf_counter() - start >= 0.4
+    assert len(samples) == 2
+    assert all(0.2 <= elapsed < 0.3 for elapsed in samples)
+
+
+def test_failed_classification_is_not_measured(controller, monkeypatch):
+    samples = []
+    monkeypatch.setattr(controller, "observe", lambda model_id, elapsed: samples.append(elapsed))
+    monkeypatch.setattr(main, "admission_controller", controller)
+
+    def classify_image(model_id, img_id, fetch_image):
+        raise FileNotFoundError(img_id)
+
+    monkeypatch.setattr(main, "classify_image", classify_image)
+    with pytest.raises(FileNotFoundError):
+        anyio.run(main.classify_admitted, "alexnet", "missing.JPEG", False)
+    assert samples == []
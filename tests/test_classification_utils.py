@@ -0,0 +1,49 @@
+import threading
+
+import pytest
+
+from app.ml.classification_utils import load_cached_model
+
+
+def test_model_is_built_once_and_reused():
+    cache, built = {}, []
+
+    def build(model_id):
+        built.append(model_id)
+        return object()
+
+    model = load_cached_model(cache, "resnet18", build)
+    assert load_cached_model(cache, "resnet18", build) is model
+    assert built == ["resnet18"]
+
+
+def test_cached_model_does_not_wait_for_other_builds():
+    cache = {"resnet18": object()}
+    started, release = threading.Event(), threading.Event()
+
+    def slow_build(model_id):
+        started.set()
+        release.wait(5)
+        return object()
+
+    builder = threading.Thread(target=load_cached_model, args=(cache, "vgg16", slow_build))
+    builder.start()
+    started.wait(5)
+    try:
+        assert load_cached_model(cache, "resnet18", slow_build) is cache["resnet18"]
+    finally:
+        release.set()
+        builder.join()
+
+
+def test_failed_build_is_not_cached():
+    cache = {}
+
+    def failing_build(model_id):
+        raise ImportError
+
+    with pytest.raises(ImportError):
+        load_cached_model(cache, "alexnet", failing_build)
+    assert "alexnet" not in cache
+    with pytest.raises(ImportError):
+        load_cached_model(cache, "not-a-model", lambda model_id: object())
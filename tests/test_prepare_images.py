@@ -0,0 +1,170 @@
+import functools
+import http.server
+import io
+import json
+import os
+import threading
+import zipfile
+
+import pytest
+from PIL import Image
+
+import prepare_images
+
+
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+    """Local stand-in of the archive mirror, honouring Range and If-Range
+    like GitHub does."""
+
+    def __init__(self, state, *args, **kwargs):
+        self.state = state
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        data, etag = self.state["data"], self.state["etag"]
+        self.state["requests"].append(dict(self.headers))
+        byte_range = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if byte_range and (if_range is None or if_range == etag):
+            start = int(byte_range[len("bytes="):-1])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+            body = data[start:]
+        else:
+            self.send_response(200)
+            body = data
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    state = {"data": os.urandom(50000), "etag": '"v1"', "requests": []}
+    httpd = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(ArchiveHandler, state)
+    )
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    state["url"] = f"http://127.0.0.1:{httpd.server_port}/master.zip"
+    yield state
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def interrupted_download(server, dest_path, size):
+    """Leaves the state of a download interrupted after size bytes."""
+    with open(dest_path + ".part", "wb") as f:
+        f.write(server["data"][:size])
+    with open(dest_path + ".part.json", "w") as f:
+        json.dump({"url": server["url"], "validator": server["etag"]}, f)
+
+
+def test_download_streams_the_file(server, tmp_path):
+    dest_path = str(tmp_path / "master.zip")
+    assert prepare_images.download(server["url"], dest_path, chunk_size=4096) == dest_path
+    with open(dest_path, "rb") as f:
+        assert f.read() == server["data"]
+    assert not os.path.exists(dest_path + ".part.json")
+
+
+def test_download_resumes_partial_file(server, tmp_path):
+    dest_path = str(tmp_path / "master.zip")
+    interrupted_download(server, dest_path, 12345)
+    prepare_images.download(server["url"], dest_path)
+    with open(dest_path, "rb") as f:
+        assert f.read() == server["data"]
+    assert server["requests"][-1]["Range"] == "bytes=12345-"
+    assert server["requests"][-1]["If-Range"] == '"v1"'
+
+
+def test_download_restarts_if_remote_file_changed(server, tmp_path):
+    dest_path = str(tmp_path / "master.zip")
+    interrupted_download(server, dest_path, 12345)
+    server["data"], server["etag"] = os.urandom(30000), '"v2"'
+    prepare_images.download(server["url"], dest_path)
+    with open(dest_path, "rb") as f:
+        assert f.read() == server["data"]
+
+
+def test_download_restarts_if_partial_file_too_long(server, tmp_path):
+    dest_path = str(tmp_path / "master.zip")
+    interrupted_download(server, dest_path, 60000)
+    prepare_images.download(server["url"], dest_path)
+    with open(dest_path, "rb") as f:
+        assert f.read() == server["data"]
+
+
+def test_download_without_validator_does_not_resume(server, tmp_path):
+    dest_path = str(tmp_path / "master.zip")
+    with open(dest_path + ".part", "wb") as f:
+        f.write(b"left over from another mirror")
+    prepare_images.download(server["url"], dest_path)
+    with open(dest_path, "rb") as f:
+        assert f.read() == server["data"]
+    assert "Range" not in server["requests"][-1]
+
+
+def test_download_uses_local_paths_in_place(tmp_path):
+    archive_path = str(tmp_path / "master.zip")
+    assert prepare_images.download(archive_path, str(tmp_path / "copy.zip")) == archive_path
+
+
+def test_extract_images_writes_manifest(tmp_path):
+    archive_path = str(tmp_path / "master.zip")
+    with zipfile.ZipFile(archive_path, "w") as zfile:
+        for i in range(8):
+            buffer = io.BytesIO()
+            Image.new("RGB", (10 + i, 20)).save(buffer, "JPEG")
+            zfile.writestr(f"imagenet-sample-images-master/n{i}.JPEG", buffer.getvalue())
+        zfile.writestr("imagenet-sample-images-master/README.md", "not an image")
+
+    img_folder = str(tmp_path / "imagenet_subset")
+    prepare_images.extract_images(archive_path, img_folder, workers=3)
+
+    with open(os.path.join(img_folder, prepare_images.Configuration.manifest_name)) as f:
+        manifest = json.load(f)
+    assert sorted(manifest) == [f"n{i}.JPEG" for i in range(8)]
+    assert manifest["n3.JPEG"]["width"] == 13
+    assert manifest["n3.JPEG"]["height"] == 20
+    assert not os.path.exists(os.path.join(img_folder, "README.md"))
+
+
+@pytest.fixture
+def folders(tmp_path, monkeypatch):
+    monkeypatch.setattr(prepare_images.Configuration, "image_folder_path", str(tmp_path / "imgs"))
+    monkeypatch.setattr(prepare_images.Configuration, "download_cache_path", str(tmp_path / "cache"))
+    return tmp_path
+
+
+def read_labels(folders):
+    with open(folders / "imgs" / "imagenet_labels.json") as f:
+        return json.load(f)
+
+
+def test_force_downloads_again(server, folders):
+    server["data"] = b'["tench", "goldfish"]'
+    prepare_images.prepare_labels(server["url"])
+    server["data"], server["etag"] = b'["tench", "goldfish", "shark"]', '"v2"'
+    prepare_images.prepare_labels(server["url"])
+    assert read_labels(folders) == ["tench", "goldfish"]
+    prepare_images.prepare_labels(server["url"], force=True)
+    assert read_labels(folders) == ["tench", "goldfish", "shark"]
+
+
+def test_other_url_is_not_served_from_cache(server, folders):
+    server["data"] = b'["tench", "goldfish"]'
+    prepare_images.prepare_labels(server["url"])
+    os.remove(folders / "imgs" / "imagenet_labels.json")
+    server["data"], server["etag"] = b'["shark"]', '"v2"'
+    prepare_images.prepare_labels(server["url"] + "?mirror=2")
+    assert read_labels(folders) == ["shark"]
@@ -0,0 +1,99 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from app.results import result_store as result_store_module
+from app.results.result_store import ResultStore
+
+SCORES = [["tabby", 60.0], ["tiger cat", 30.0], ["Egyptian cat", 5.0],
+          ["lynx", 3.0], ["tiger", 2.0]]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_results_expire_after_ttl():
+    clock = Clock()
+    store = ResultStore(max_entries=10, ttl=60, clock=clock)
+    result_id = store.put(SCORES)
+    json_bytes, expires = store.get_json(result_id)
+    assert b"tabby" in json_bytes
+    assert expires == 1060.0
+    clock.now = 1061.0
+    with pytest.raises(KeyError):
+        store.get_json(result_id)
+
+
+def test_store_is_bounded():
+    store = ResultStore(max_entries=2, ttl=60)
+    result_ids = [store.put(SCORES) for _ in range(3)]
+    with pytest.raises(KeyError):
+        store.get_json(result_ids[0])
+    for result_id in result_ids[1:]:
+        store.get_json(result_id)
+
+
+def test_sqlite_round_trip(tmp_path):
+    db_path = str(tmp_path / "results.db")
+    first = ResultStore(max_entries=10, ttl=60, db_path=db_path)
+    result_id = first.put(SCORES)
+    png_bytes, _ = first.get_png(result_id)
+
+    second = ResultStore(max_entries=10, ttl=60, db_path=db_path)
+    json_bytes, _ = second.get_json(result_id)
+    assert json_bytes == first.get_json(result_id)[0]
+    assert second.get_png(result_id)[0] == png_bytes
+
+
+def test_sqlite_table_is_bounded(tmp_path):
+    db_path = str(tmp_path / "results.db")
+    store = ResultStore(max_entries=2, ttl=60, db_path=db_path)
+    result_ids = [store.put(SCORES) for _ in range(5)]
+    other = ResultStore(max_entries=2, ttl=60, db_path=db_path)
+    assert other._db.execute("SELECT COUNT(*) FROM results").fetchone()[0] == 2
+    with pytest.raises(KeyError):
+        other.get_json(result_ids[0])
+
+
+def test_png_rendered_once(monkeypatch):
+    renders = []
+
+    def render(classification_scores):
+        renders.append(classification_scores)
+        return b"\x89PNG"
+
+    monkeypatch.setattr(result_store_module, "render_scores_png", render)
+    store = ResultStore(max_entries=10, ttl=60)
+    result_id = store.put(SCORES)
+    assert store.get_png(result_id)[0] == b"\x89PNG"
+    assert store.get_png(result_id)[0] == b"\x89PNG"
+    assert renders == [SCORES]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "result_store", ResultStore(max_entries=10, ttl=60))
+    return TestClient(main.app)
+
+
+@pytest.mark.parametrize("kind", ["json", "png"])
+def test_download_unknown_result(client, kind):
+    assert client.get(f"/download/{kind}/unknown").status_code == 404
+
+
+@pytest.mark.parametrize("kind", ["json", "png"])
+def test_download_cached_by_client(client, kind):
+    result_id = main.result_store.put(SCORES)
+    response = client.get(f"/download/{kind}/{result_id}")
+    assert response.status_code == 200
+    assert "max-age=" in response.headers["cache-control"]
+    etag = response.headers["etag"]
+
+    response = client.get(f"/download/{kind}/{result_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
@@ -0,0 +1,99 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from app.config import Configuration
+from app.ml import similarity_utils
+
+N_IMAGES = 10
+
+
+def tiny_model(model_id):
+    """Stand-in of the torchvision models, its features are the input of
+    the last linear layer like for the real backbones."""
+    torch.manual_seed(0)
+    return torch.nn.Sequential(
+        torch.nn.AdaptiveAvgPool2d(4),
+        torch.nn.Flatten(),
+        torch.nn.Linear(48, 10),
+    )
+
+
+def add_image(folder, name, seed):
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 255, (32, 40, 3), dtype=np.uint8)
+    Image.fromarray(pixels).save(os.path.join(folder, name), "JPEG")
+
+
+@pytest.fixture
+def gallery(tmp_path, monkeypatch):
+    img_folder = tmp_path / "imagenet_subset"
+    img_folder.mkdir()
+    for i in range(N_IMAGES):
+        add_image(img_folder, f"n{i:03d}.JPEG", i)
+    # n001 is a copy of n000, their embeddings are the same
+    shutil.copy(img_folder / "n000.JPEG", img_folder / "n001.JPEG")
+    monkeypatch.setattr(Configuration, "image_folder_path", str(img_folder))
+    monkeypatch.setattr(Configuration, "index_folder_path", str(tmp_path / "index"))
+    monkeypatch.setattr(similarity_utils, "get_model", tiny_model)
+    return img_folder
+
+
+def test_exact_search_excludes_query_image(gallery):
+    similarity_utils.build_index("resnet18", nlist=0)
+    similar = similarity_utils.find_similar_images("resnet18", "n000.JPEG", k=N_IMAGES)
+    ids = [image_id for image_id, _ in similar]
+    assert "n000.JPEG" not in ids
+    assert len(ids) == N_IMAGES - 1
+    assert ids[0] == "n001.JPEG"
+    assert similar[0][1] == pytest.approx(1.0, abs=1e-2)
+    scores = [score for _, score in similar]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_ivf_lists_cover_every_row(gallery):
+    similarity_utils.build_index("resnet18", nlist=3)
+    offsets = similarity_utils.load_index("resnet18").offsets
+    assert len(offsets) == 4
+    assert offsets[0] == 0 and offsets[-1] == N_IMAGES
+    assert np.all(np.diff(offsets) >= 0)
+
+
+def test_ivf_lists_clamped_to_gallery_size(gallery):
+    similarity_utils.build_index("resnet18", nlist=100)
+    index = similarity_utils.load_index("resnet18")
+    assert len(index.centroids) == N_IMAGES
+    assert index.offsets[-1] == N_IMAGES
+    # every image is found when all the lists are probed
+    similar = index.search(index.embeddings[0], k=N_IMAGES, nprobe=N_IMAGES)
+    assert len(similar) == N_IMAGES
+
+
+def test_rebuild_keeps_ids_and_embeddings_paired(gallery):
+    similarity_utils.build_index("resnet18", nlist=0)
+    exact = similarity_utils.load_index("resnet18")
+    by_id = {image_id: np.array(exact.embeddings[row]) for image_id, row in exact.rows.items()}
+
+    # the IVF build reorders the rows, the running process must see it
+    similarity_utils.build_index("resnet18", nlist=3)
+    ivf = similarity_utils.load_index("resnet18")
+    assert ivf is not exact
+    assert ivf.embeddings.shape[0] == len(ivf.ids)
+    for image_id, row in ivf.rows.items():
+        np.testing.assert_array_equal(ivf.embeddings[row], by_id[image_id])
+
+    index_dir = os.path.join(Configuration.index_folder_path, "resnet18")
+    arrays = sorted(name for name in os.listdir(index_dir) if name.endswith(".npy"))
+    assert len(arrays) == 3
+
+
+def test_changed_gallery_is_out_of_date(gallery):
+    similarity_utils.build_index("resnet18", nlist=0)
+    similarity_utils.load_index("resnet18")
+    add_image(gallery, "n100.JPEG", 100)
+    with pytest.raises(ValueError, match="out of date"):
+        similarity_utils.load_index("resnet18")